@@ -20,7 +20,7 @@ import time
 from typing import List, Tuple
 
 import numpy as np
-from utils import get_tokenizer, sample_requests, send_request
+from utils import get_tokenizer, latency_columns, sample_requests, send_request
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -69,18 +69,12 @@ def main(args: argparse.Namespace):
     print(f"Throughput: {len(REQUEST_LATENCY) / benchmark_time:.2f} requests/s")
 
     # Compute the latency statistics.
-    avg_latency = np.mean([latency for _, _, latency in REQUEST_LATENCY])
+    prompt_lens, output_lens, latencies = latency_columns(REQUEST_LATENCY)
+    avg_latency = latencies.mean()
     print(f"Average latency: {avg_latency:.2f} s")
-    avg_per_token_latency = np.mean(
-        [
-            latency / (prompt_len + output_len)
-            for prompt_len, output_len, latency in REQUEST_LATENCY
-        ]
-    )
+    avg_per_token_latency = (latencies / (prompt_lens + output_lens)).mean()
     print(f"Average latency per token: {avg_per_token_latency:.2f} s")
-    avg_per_output_token_latency = np.mean(
-        [latency / output_len for _, output_len, latency in REQUEST_LATENCY]
-    )
+    avg_per_output_token_latency = (latencies / output_lens).mean()
     print("Average latency per output token: " f"{avg_per_output_token_latency:.2f} s")
 
 
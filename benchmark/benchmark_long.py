@@ -19,9 +19,12 @@ import random
 import time
 from typing import List, Tuple
 
-import numpy as np
-
-from utils import generate_sorting_prompts, get_tokenizer, send_request
+from utils import (
+    generate_sorting_prompts,
+    get_tokenizer,
+    latency_columns,
+    send_request,
+)
 
 
 logging.basicConfig(level=logging.INFO)
@@ -109,26 +112,16 @@ def main(args: argparse.Namespace):
     print(f"Throughput: {args.num_prompts / benchmark_time:.2f} requests/s")
 
     # Compute the latency statistics.
-    avg_latency = np.mean([latency for _, _, latency in REQUEST_LATENCY])
+    prompt_lens, output_lens, latencies = latency_columns(REQUEST_LATENCY)
+    avg_latency = latencies.mean()
     print(f"Average latency: {avg_latency:.2f} s")
-    avg_per_token_latency = np.mean(
-        [
-            latency / (prompt_len + output_len)
-            for prompt_len, output_len, latency in REQUEST_LATENCY
-        ]
-    )
+    avg_per_token_latency = (latencies / (prompt_lens + output_lens)).mean()
     print(f"Average latency per token: {avg_per_token_latency:.2f} s")
-    avg_per_output_token_latency = np.mean(
-        [latency / output_len for _, output_len, latency in REQUEST_LATENCY]
-    )
+    avg_per_output_token_latency = (latencies / output_lens).mean()
     print("Average latency per output token: " f"{avg_per_output_token_latency:.2f} s")
-    average_io_tokens = np.average(
-        [(prompt_len + output_len) for prompt_len, output_len, _ in REQUEST_LATENCY]
-    )
+    average_io_tokens = (prompt_lens + output_lens).mean()
     print(f"Average io length:" f"{average_io_tokens}")
-    throughput = (
-        sum([output_len for _, output_len, _ in REQUEST_LATENCY]) / benchmark_time
-    )
+    throughput = output_lens.sum() / benchmark_time
     print(f"Throughput: {throughput} tokens/s")
 
 
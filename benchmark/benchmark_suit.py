@@ -12,46 +12,99 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
-
 import argparse
 import asyncio
+import csv
 import logging
+import math
 import random
 import time
 
+import aiohttp
 import numpy as np
-import pandas as pd
+import orjson
 import datetime
 import os
 import textwrap
 
-from typing import List, Tuple
-from utils import sample_requests, get_tokenizer, send_request
+from typing import Any, Dict, Iterator, List, Tuple
+from utils import (
+    REQUEST_TIMEOUT,
+    LatencyHistogram,
+    sample_requests,
+    get_tokenizer,
+    send_request,
+)
 
 from benchmark_serving import BenchmarkRunner
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PERCENTILES = (50, 95, 99)
+METRICS = ("latency", "per_token_latency", "per_output_token_latency")
+
+
+def welford_update(acc: List[float], x: float):
+    """Add x to a streaming [count, mean, M2] accumulator."""
+    acc[0] += 1
+    delta = x - acc[1]
+    acc[1] += delta / acc[0]
+    acc[2] += delta * (x - acc[1])
 
-class AutoBenchmarkRunner(BenchmarkRunner):
 
+def welford_result(acc: List[float]) -> Tuple[float, float]:
+    """Return the mean and the sample standard deviation of the accumulator."""
+    count, mean, m2 = acc
+    if count == 0:
+        return float("nan"), float("nan")
+    std = math.sqrt(m2 / (count - 1)) if count > 1 else float("nan")
+    return mean, std
+
+
+def iter_json_files(root: str) -> Iterator[str]:
+    """Yield the .json files under root, recursively."""
+    try:
+        it = os.scandir(root)
+    except OSError as e:
+        # Skip directories that cannot be listed, like os.walk does
+        logger.warning(f"Cannot list directory {root!r}: {e}")
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_json_files(entry.path)
+            elif entry.is_file() and entry.name.endswith('.json'):
+                yield entry.path
+
+
+class AutoBenchmarkRunner(BenchmarkRunner):
+    # Shared by all configs, loading and sampling are expensive
+    _tokenizer_cache: Dict[Tuple[str, bool], Any] = {}
+    _sample_cache: Dict[Tuple[str, int, Tuple[str, bool], int], List[Tuple[str, int, int]]] = {}
 
     def __init__(self, args):
         self.inf = args.inf
         self.json_filename:str = args.file
         self.folder:str = args.folder
         self.configs = []
+        self._cfg_i = 0
+        self._cached_config = None
 
-        # Benchmark Result
-        self.REQUEST_LATENCY: List[Tuple[int, int, float]] = [] 
+        # Benchmark Result, streamed per config and reset by read_json()
+        self._output_tokens = 0
+        self._acc: Dict[str, List[float]] = {}
+        self.histograms = {}
         
         self.throughput_request = None
         self.throughput_token = None
         self.avg_latency = None
+        self.std_latency = None
         self.avg_per_token_latency = None
         self.avg_per_output_token_latency = None
+        self.percentiles = {}
+        self._results_file = None
+        self._results_writer = None
         
 
         # Benchmark Info
@@ -66,43 +119,95 @@ class AutoBenchmarkRunner(BenchmarkRunner):
 
         self.api_url:str = None
         self.input_requests = None
-        self.queue = None
         self.left = None
+        self._start_time = None
+        self._arrivals: List[float] = None
+        self._next_idx = 0
+        self._last_print = 0.0
+        self.session: aiohttp.ClientSession = None
 
 
         # MUST provide
         self.tokenizer:str = None
         self.model_uid:str = None
 
+    async def run(self):
+        """
+        start the workers, and wait them to send all the requests"""
+        if self.request_rate == float("inf"):
+            # If the request rate is infinity, then we don't need to wait.
+            arrivals = np.zeros(len(self.input_requests))
+        else:
+            # Sample the request intervals from the exponential distribution,
+            # each request will be sent at its arrival time.
+            arrivals = np.cumsum(
+                np.random.exponential(1.0 / self.request_rate, len(self.input_requests))
+            )
+        self._arrivals = arrivals.tolist()
+        self._next_idx = 0
+
+        # All workers share one connection pool, so requests reuse the
+        # connections instead of paying a new handshake each time
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=REQUEST_TIMEOUT
+        ) as session:
+            self.session = session
+            self._start_time = asyncio.get_running_loop().time()
+            await asyncio.gather(*[self.worker() for _ in range(self.concurrency)])
+        self.session = None
+        # The last one
+        print("")
+
     async def worker(self):
         """
-        wait request dispatch by run(), and then send_request.
-        When all request is done, most worker will hang on self.queue,
-        but at least one worker will exit"""
-        while self.left > 0:
-            prompt, prompt_len, output_len = await self.queue.get()
-            await send_request(
+        claim the next request and send_request, never earlier than its
+        arrival time. Exit when all requests are claimed"""
+        loop = asyncio.get_running_loop()
+        while self._next_idx < len(self.input_requests):
+            # asyncio is single-threaded, claiming the index needs no lock
+            i = self._next_idx
+            self._next_idx += 1
+            prompt, prompt_len, output_len = self.input_requests[i]
+            delay = self._start_time + self._arrivals[i] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            result = await send_request(
                 self.api_url,
                 self.model_uid,
                 prompt,
                 prompt_len,
                 output_len,
-                self.REQUEST_LATENCY,
+                None,
+                session=self.session,
             )
+            if result is not None:
+                self.record(*result)
 
             self.left -= 1
-            # pring longer space to overwrite the previous when left decrease
-            print("\rdone_request, left %d    " % (self.left), end="")
-        # The last one
-        print("")
+            # Refresh progress at most 10 times per second to keep stdout
+            # writes from perturbing the measured latency
+            now = time.monotonic()
+            if now - self._last_print > 0.1 or self.left == 0:
+                self._last_print = now
+                # pring longer space to overwrite the previous when left decrease
+                print("\rdone_request, left %d    " % (self.left), end="")
+
+    def record(self, prompt_len: int, output_len: int, latency: float):
+        # asyncio is single-threaded, updating the accumulators needs no lock
+        self._output_tokens += output_len
+        values = {
+            "latency": latency,
+            "per_token_latency": latency / (prompt_len + output_len),
+            "per_output_token_latency": latency / output_len,
+        }
+        for name, value in values.items():
+            welford_update(self._acc[name], value)
+            self.histograms[name].add(value)
 
     def traverse_json_configs(self):
         print(f"Searching Folder{self.folder!r}...")
-        for root, dirs, files in os.walk(self.folder):
-            for file_name in files:
-                if file_name.endswith('.json'):
-                    file_path = os.path.join(root, file_name)
-                    self.configs.append(file_path)
+        self.configs.extend(iter_json_files(self.folder))
         print(f"Found file: {self.configs!r}")
 
     def write_result(self):
@@ -110,13 +215,27 @@ class AutoBenchmarkRunner(BenchmarkRunner):
                 'throughput_request': self.throughput_request , 
                 'throughput_token': self.throughput_token, 
                 'avg_latency' : self.avg_latency,
+                'std_latency': self.std_latency,
                 'avg_per_token_latency': self.avg_per_token_latency,
-                'avg_per_output_token_latency': self.avg_per_output_token_latency}
+                'avg_per_output_token_latency': self.avg_per_output_token_latency,
+                **self.percentiles}
         
-        dataframe = pd.DataFrame.from_dict(dict, orient='index')
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        csv_filename = f'{self.model_uid}_output_{timestamp}.csv'
-        dataframe.to_csv(csv_filename)
+        if self._results_file is None:
+            # One result file for the whole run, one row per config
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+            csv_filename = f'benchmark_result_{timestamp}.csv'
+            self._results_file = open(csv_filename, 'a', newline='')
+            self._results_writer = csv.writer(self._results_file)
+            self._results_writer.writerow(dict.keys())
+        self._results_writer.writerow(dict.values())
+        # Keep finished results on disk, infinite benchmark never returns
+        self._results_file.flush()
+
+    def close(self):
+        if self._results_file is not None:
+            self._results_file.close()
+            self._results_file = None
+            self._results_writer = None
     
     def read_file(self, filename:str):
         if filename.endswith('.json'):
@@ -125,16 +244,21 @@ class AutoBenchmarkRunner(BenchmarkRunner):
             logger.error("Invalid config file")
     
     def read_json(self):
+        self.json_filename = self.configs[self._cfg_i]
         if self.inf:
             logger.info("Infinite Benchmark Enabled!")
-            # Never Pop() for infinite benchmark
-            self.json_filename = self.configs[0]
         else:
-            self.json_filename = self.configs.pop()
+            # Infinite benchmark reuses the same config, only advance otherwise
+            self._cfg_i += 1
         
-        print(f"Loading file: {self.json_filename!r}")
-        with open(self.json_filename, "r") as f:
-            data = json.load(f)
+        if self.inf and self._cached_config is not None:
+            # Infinite benchmark always reruns the same file, parse it once
+            data = self._cached_config
+        else:
+            print(f"Loading file: {self.json_filename!r}")
+            with open(self.json_filename, "rb") as f:
+                data = orjson.loads(f.read())
+            self._cached_config = data
         
         print(f"Read from {self.json_filename!r}\n")
 
@@ -154,22 +278,44 @@ class AutoBenchmarkRunner(BenchmarkRunner):
         print(f"Model_UID: {self.model_uid!r}")
         
         # Get tokenizer
-        self.tokenizer = get_tokenizer(self.tokenizer, trust_remote_code=self.trust_remote_code)
-        self.input_requests = sample_requests(self.dataset, self.num_prompts, self.tokenizer)
+        tokenizer_key = (self.tokenizer, self.trust_remote_code)
+        if tokenizer_key not in self._tokenizer_cache:
+            self._tokenizer_cache[tokenizer_key] = get_tokenizer(
+                self.tokenizer, trust_remote_code=self.trust_remote_code
+            )
+        self.tokenizer = self._tokenizer_cache[tokenizer_key]
+
+        sample_key = (self.dataset, self.num_prompts, tokenizer_key, self.seed)
+        if sample_key not in self._sample_cache:
+            # Seed before sampling so the cached requests match the config
+            random.seed(self.seed)
+            self._sample_cache[sample_key] = sample_requests(
+                self.dataset, self.num_prompts, self.tokenizer
+            )
+        self.input_requests = self._sample_cache[sample_key]
 
         self.left = len(self.input_requests)
 
+        self._output_tokens = 0
+        self._acc = {name: [0, 0.0, 0.0] for name in METRICS}
+        self.histograms = {name: LatencyHistogram() for name in METRICS}
+
         # Fix Concurrency
         if self.concurrency > self.num_prompts:
             print("Fix concurrency with num_prompts %d" % (self.num_prompts))
             self.concurrency = self.num_prompts
 
 
-        self.queue = asyncio.Queue(self.concurrency or 100)
 
+def main(args: argparse.Namespace):
+    try:
+        # Lower scheduling overhead for many concurrent workers, if available
+        import uvloop
 
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
-def main(args: argparse.Namespace):
     benchmark = AutoBenchmarkRunner(args)
     if args.file is None and args.folder is not None:
         benchmark.traverse_json_configs()
@@ -181,7 +327,7 @@ def main(args: argparse.Namespace):
         logger.error("Cannot provide both folder and file parameters at the same time.")
 
     
-    while benchmark.configs != []:
+    while benchmark._cfg_i < len(benchmark.configs):
         benchmark.read_json()
         logger.info("Preparing for benchmark.")
         
@@ -207,35 +353,36 @@ def main(args: argparse.Namespace):
         
         print(f"Benchmark Throughput Request: {benchmark.throughput_request!r}")
 
-        benchmark.throughput_token = (
-            sum([output_len for _, output_len, _ in benchmark.REQUEST_LATENCY]) / benchmark_time
-        )
-
+        benchmark.throughput_token = benchmark._output_tokens / benchmark_time
 
         print(f"Benchmark Throughput Token: {benchmark.throughput_token!r}")
         
-        benchmark.avg_latency = np.mean([latency for _, _, latency in benchmark.REQUEST_LATENCY])
+        benchmark.avg_latency, benchmark.std_latency = welford_result(benchmark._acc["latency"])
         
         print(f"Benchmark avg latency: {benchmark.avg_latency!r}")
+        print(f"Benchmark std latency: {benchmark.std_latency!r}")
         
-        
-        benchmark.avg_per_token_latency = np.mean(
-            [
-                latency / (prompt_len + output_len)
-                for prompt_len, output_len, latency in benchmark.REQUEST_LATENCY
-            ]
-        )
+        benchmark.avg_per_token_latency, _ = welford_result(benchmark._acc["per_token_latency"])
         
         print(f"Benchmark avg per token latency: {benchmark.avg_per_token_latency!r}")
 
-        benchmark.avg_per_output_token_latency = np.mean(
-            [latency / output_len for _, output_len, latency in benchmark.REQUEST_LATENCY]
+        benchmark.avg_per_output_token_latency, _ = welford_result(
+            benchmark._acc["per_output_token_latency"]
         )
 
         print(f"Benchmark avg per token output latency: {benchmark.avg_per_output_token_latency!r}")
+
+        benchmark.percentiles = {}
+        for name, histogram in benchmark.histograms.items():
+            for p in PERCENTILES:
+                value = histogram.quantile(p / 100)
+                benchmark.percentiles[f"p{p}_{name}"] = value
+                print(f"Benchmark p{p} {name.replace('_', ' ')}: {value!r}")
         print("Result generation finished\n")
         
         benchmark.write_result()
+
+    benchmark.close()
         
 
 if __name__ == "__main__":
@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import aiohttp
+import contextlib
 import json
 import logging
+import math
 import random
 import time
-from typing import TYPE_CHECKING, List, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
+import numpy as np
 import openai
 from transformers import AutoTokenizer, PreTrainedTokenizerFast
 
@@ -31,6 +34,8 @@ if TYPE_CHECKING:
 # A fast LLaMA tokenizer with the pre-processed `tokenizer.json` file.
 _FAST_LLAMA_TOKENIZER = "hf-internal-testing/llama-tokenizer"
 
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=3 * 3600)
+
 
 def get_tokenizer(
     tokenizer_name: str,
@@ -139,6 +144,49 @@ def sample_requests(
     return sampled_requests
 
 
+def latency_columns(
+    stats: List[Tuple[int, int, float]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Split the recorded (prompt_len, output_len, latency) stats into columns."""
+    columns = np.asarray(stats, dtype=np.float64).reshape(-1, 3)
+    prompt_lens, output_lens, latencies = columns.T
+    return prompt_lens, output_lens, latencies
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of positive values, in the spirit of DDSketch.
+    Adding a sample is O(1), and quantiles are answered from a fixed number of
+    buckets with a bounded relative error, whatever the number of samples."""
+
+    def __init__(
+        self,
+        relative_error: float = 0.01,
+        min_value: float = 1e-6,
+        max_value: float = 1e4,
+    ):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self.gamma)
+        self._min_value = min_value
+        self._offset = math.ceil(math.log(min_value) / self._log_gamma)
+        num_buckets = math.ceil(math.log(max_value) / self._log_gamma) - self._offset + 1
+        self.counts = np.zeros(num_buckets, dtype=np.int64)
+
+    def add(self, value: float):
+        # Bucket i holds values in (gamma ** (i - 1), gamma ** i]
+        key = math.ceil(math.log(max(value, self._min_value)) / self._log_gamma)
+        index = min(max(key - self._offset, 0), len(self.counts) - 1)
+        self.counts[index] += 1
+
+    def quantile(self, q: float) -> float:
+        cumulative = np.cumsum(self.counts)
+        total = cumulative[-1]
+        if total == 0:
+            return float("nan")
+        index = int(np.searchsorted(cumulative, q * (total - 1), side="right"))
+        return 2 * self.gamma ** (index + self._offset) / (self.gamma + 1)
+
+
 def generate_sorting_prompts(
     num_prompts: int,
     context_length: int,
@@ -172,8 +220,9 @@ async def send_request(
     prompt: str,
     prompt_len: int,
     output_len: int,
-    stats: List[Tuple[int, int, float]],  # output.
-) -> None:
+    stats: Optional[List[Tuple[int, int, float]]],  # output.
+    session: Optional[aiohttp.ClientSession] = None,
+) -> Optional[Tuple[int, int, float]]:
     request_start_time = time.time()
 
     pload = {
@@ -188,14 +237,22 @@ async def send_request(
 
     headers = {"User-Agent": "Benchmark Client"}
 
-    timeout = aiohttp.ClientTimeout(total=3 * 3600)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    async with contextlib.AsyncExitStack() as stack:
+        if session is None:
+            # No shared session, connect for this request only.
+            session = await stack.enter_async_context(
+                aiohttp.ClientSession(timeout=REQUEST_TIMEOUT)
+            )
         async with session.post(api_url, headers=headers, json=pload) as response:
             resp = await response.json()
             if response.status == 200:
                 completion_tokens = resp["usage"]["completion_tokens"]
                 request_end_time = time.time()
                 request_latency = request_end_time - request_start_time
-                stats.append((prompt_len, completion_tokens, request_latency))
+                result = (prompt_len, completion_tokens, request_latency)
+                if stats is not None:
+                    stats.append(result)
+                return result
             else:
                 logger.error(f"Failed to create chat completion: {resp}")
+                return None